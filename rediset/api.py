@@ -1,4 +1,5 @@
 import hashlib
+import time
 import redis
 
 
@@ -18,17 +19,47 @@ class Rediset(object):
     # All cache keys will be prefixed with this string
     CACHE_KEY_PREFIX = 'cached'
 
+    # The number of created keys to remember, see create_key
+    KEY_MEMO_SIZE = 4096
+
     def __init__(self, key_prefix=None, default_cache_seconds=60,
                  redis_client=None, hash_generated_keys=False):
         self.key_prefix = key_prefix
         self.hash_generated_keys = hash_generated_keys
         self.redis = redis_client or redis.Redis()
         self.default_cache_seconds = default_cache_seconds
+        self.key_memo = {}
+
+        # Used to decide when cached results have expired on the client
+        # side. Tests replace this with a fake clock.
+        self.clock = time.time
 
     def hash_key(self, key):
         return hashlib.md5(key).hexdigest()
 
     def create_key(self, original_key, generated=False, is_cache_key=False):
+        """
+        Keys are created for every node each time it is used, so remember
+        them. The settings that affect keys are part of the memo key, so
+        this method never returns a key built with old settings. Operation
+        nodes remember their own keys though, so nodes created before a
+        change of key_prefix or hash_generated_keys keep their old keys.
+        """
+        memo_key = (original_key, generated, is_cache_key,
+                    self.key_prefix, self.hash_generated_keys)
+        try:
+            return self.key_memo[memo_key]
+        except KeyError:
+            pass
+
+        if len(self.key_memo) >= self.KEY_MEMO_SIZE:
+            self.key_memo.clear()
+
+        key = self.build_key(original_key, generated, is_cache_key)
+        self.key_memo[memo_key] = key
+        return key
+
+    def build_key(self, original_key, generated=False, is_cache_key=False):
         key = original_key
 
         if generated and self.hash_generated_keys:
@@ -57,6 +88,13 @@ class Rediset(object):
         if self._is_weighted(items[0]):
             kwargs["weights"] = [item[1] for item in items]
             items = [item[0] for item in items]
+        # Scores are combined once for each time a sorted set is given,
+        # but a set given twice makes no difference, so don't send it twice
+        if cls is setcls:
+            if cls is sets.DifferenceNode:
+                items = list(items[:1]) + self._unique(items[1:])
+            else:
+                items = self._unique(items)
         if len(items) == 1:
             item = items[0]
             if isinstance(item, basestring):
@@ -67,6 +105,20 @@ class Rediset(object):
         kwargs.setdefault('cache_seconds', self.default_cache_seconds)
         return cls(self, items, **kwargs)
 
+    def _unique(self, items):
+        """
+        Remove repeated sets from items, keeping the first of each
+        """
+        unique = []
+        seen = set()
+        for item in items:
+            if isinstance(item, basestring):
+                item = self.Set(item)
+            if item not in seen:
+                seen.add(item)
+                unique.append(item)
+        return unique
+
     def _is_sorted(self, item):
         """
         A SortedNode might be specified on its own or as part of a
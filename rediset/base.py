@@ -1,3 +1,51 @@
+from contextlib import contextmanager
+
+
+# Performs an operation (unless its cached result is still fresh), and then
+# runs a read command against the result. This lets us compute and fetch an
+# operation whose children are all leaf nodes in a single round trip.
+#
+#   KEYS[1]       result key
+#   KEYS[2]       cache key
+#   KEYS[3..]     the keys the operation is performed on
+#   ARGV[1]       cache seconds, or 0 if the result isn't cached
+#   ARGV[2]       seconds to keep an uncached result for
+#   ARGV[3]       operation command
+#   ARGV[4]       1 if the command takes the number of keys before them
+#   ARGV[5]       n, the number of operation options that follow
+#   ARGV[6..5+n]  operation options, after the keys (eg WEIGHTS)
+#   ARGV[6+n]     read command
+#   ARGV[7+n..]   read command arguments after the result key
+#
+# Returns {1 if the operation was performed or 0 if not, reply to the read}
+COMPUTE_AND_FETCH_SCRIPT = """
+local cache_seconds = tonumber(ARGV[1])
+local n = tonumber(ARGV[5])
+local performed = 0
+if cache_seconds == 0 or redis.call('EXISTS', KEYS[2]) == 0 then
+    local args = {}
+    if ARGV[4] == '1' then
+        table.insert(args, #KEYS - 2)
+    end
+    for i = 3, #KEYS do
+        table.insert(args, KEYS[i])
+    end
+    for i = 6, 5 + n do
+        table.insert(args, ARGV[i])
+    end
+    redis.call('UNLINK', KEYS[1])
+    redis.call(ARGV[3], KEYS[1], unpack(args))
+    if cache_seconds == 0 then
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+    else
+        redis.call('SET', KEYS[2], 1, 'EX', cache_seconds)
+        redis.call('EXPIRE', KEYS[1], cache_seconds)
+    end
+    performed = 1
+end
+return {performed, redis.call(ARGV[6 + n], KEYS[1], unpack(ARGV, 7 + n))}
+"""
+
 
 class Node(object):
 
@@ -10,9 +58,32 @@ class Node(object):
     by leaf nodes and not intermediate operation nodes.
     """
 
+    is_sorted = False
+
     def __repr__(self):
         return "<%s.%s %s>" % (__name__, self.__class__.__name__, self.key)
 
+    def __eq__(self, other):
+        """
+        Nodes are equal if they are both sets or both sorted sets, and
+        represent the same key in Redis. So equivalent operations (eg
+        Intersection('a', 'b') and Intersection('b', 'a')) are equal, and
+        can be used as dict keys
+        """
+        if not isinstance(other, Node):
+            return NotImplemented
+        return (self.is_sorted == other.is_sorted and
+                self.prefixed_key == other.prefixed_key)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash((self.is_sorted, self.prefixed_key))
+
     def cardinality(self):
         self.create()
         return self.rs.redis.scard(self.prefixed_key)
@@ -21,9 +92,19 @@ class Node(object):
         return self.cardinality()
 
     def members(self):
+        """
+        Returns the set built by redis-py from the SMEMBERS reply as-is,
+        without copying it
+        """
         self.create()
         return self.rs.redis.smembers(self.prefixed_key)
 
+    def members_frozen(self, *args, **kwargs):
+        """
+        The members as a frozenset, for callers that need them hashable
+        """
+        return frozenset(self.members(*args, **kwargs))
+
     def __iter__(self):
         return iter(self.members())
 
@@ -34,6 +115,18 @@ class Node(object):
     def __contains__(self, item):
         return self.contains(item)
 
+    def contains_many(self, *items):
+        """
+        Check the membership of several items in a single round trip.
+        Returns a list of booleans in the same order as the items.
+        Requires Redis 6.2 or later (SMISMEMBER).
+        """
+        if not items:
+            return []
+        self.create()
+        results = self.rs.redis.execute_command('SMISMEMBER', self.prefixed_key, *items)
+        return [bool(result) for result in results]
+
     def intersection(self, *others, **kwargs):
         sets = (self,) + others
         return self.rs.Intersection(*sets, **kwargs)
@@ -54,6 +147,47 @@ class Node(object):
         return self.rs.create_key(self.key)
 
 
+class LeafNode(Node):
+
+    """
+    Represents a set stored in Redis under a user-specified key
+
+    Unlike the results of operations, leaf nodes can be mutated. Mutating
+    calls are sent to `self.writer`, which is either the Redis client or,
+    inside an `atomic` block, a pipeline that buffers them.
+    """
+
+    def __init__(self, rediset, key):
+        self.rs = rediset
+        self.key = key
+        self.pipeline = None
+
+    @property
+    def writer(self):
+        if self.pipeline is not None:
+            return self.pipeline
+        return self.rs.redis
+
+    @contextmanager
+    def atomic(self):
+        """
+        Buffer all writes made to this set inside a `with` block, and send
+        them to Redis as a single MULTI/EXEC transaction (one round trip)
+        when the block exits. Note that the return values of mutating
+        calls (eg increment) are not available inside the block.
+        """
+        if self.pipeline is not None:
+            yield self
+            return
+
+        self.pipeline = self.rs.redis.pipeline()
+        try:
+            yield self
+            self.pipeline.execute()
+        finally:
+            self.pipeline = None
+
+
 class OperationNode(Node):
 
     """
@@ -65,6 +199,11 @@ class OperationNode(Node):
     may represent the result of another operation.
     """
 
+    # Operations with cache_seconds=0 are performed every time they are
+    # used, but sometimes their results must still be stored (eg for a
+    # parent operation to use). Those results expire after this long.
+    UNCACHED_RESULT_SECONDS = 10
+
     def __init__(self, rediset, children, cache_seconds=None):
         self.rs = rediset
 
@@ -79,6 +218,25 @@ class OperationNode(Node):
         self.children = processed_children
         self.cache_seconds = cache_seconds
 
+        # Operations are immutable, so their keys only need generating once.
+        # The prefixed keys (which may be hashed) are generated on first use
+        self.key = self.generate_key()
+        self.generated_keys = {}
+
+        # When this node last cached its result, that result expires
+        self.cache_expires = None
+
+    def generated_key(self, is_cache_key=False):
+        if is_cache_key not in self.generated_keys:
+            key = self.key
+            if not self.cache_seconds:
+                # Kept apart from the cached result of the same operation,
+                # which storing an uncached result would otherwise shorten
+                key = "uncached:%s" % key
+            self.generated_keys[is_cache_key] = self.rs.create_key(
+                key, generated=True, is_cache_key=is_cache_key)
+        return self.generated_keys[is_cache_key]
+
     @property
     def prefixed_key(self):
         """
@@ -86,39 +244,216 @@ class OperationNode(Node):
         all have a common prefix, to distinguish them from user-specified
         keys representing sets or sorted sets
         """
-        return self.rs.create_key(self.key, generated=True)
+        return self.generated_key()
 
     @property
     def prefixed_cache_key(self):
-        return self.rs.create_key(self.key, generated=True, is_cache_key=True)
+        return self.generated_key(is_cache_key=True)
+
+    def cardinality(self):
+        return self.compute_and_fetch(self.cardinality_command)
+
+    def setup_cache(self, pipe):
+        if not self.cache_seconds:
+            # Nothing will reuse the result, but it shouldn't linger either
+            pipe.expire(self.prefixed_key, self.UNCACHED_RESULT_SECONDS)
+            return
 
-    def setup_cache(self):
-        pipe = self.rs.redis.pipeline()
-        pipe.setex(self.prefixed_cache_key, 1, self.cache_seconds)
+        # Taken before the TTL is set in Redis, so that cache_expires is
+        # never later than the result really expires
+        self.cache_updated(self.rs.clock())
+        pipe.set(self.prefixed_cache_key, 1, ex=self.cache_seconds)
         pipe.expire(self.prefixed_key, self.cache_seconds)
-        pipe.execute()
 
-    def create_children(self):
+    def cache_updated(self, now):
+        """
+        Called when the operation has been performed and cached at `now`
+        """
+        self.cache_expires = now + self.cache_seconds
+
+    def operation_nodes(self):
+        """
+        Yield this node and every operation node beneath it in the tree
+        """
+        yield self
+        for child in self.children:
+            if isinstance(child, OperationNode):
+                for node in child.operation_nodes():
+                    yield node
+
+    def collect_keys(self):
+        """
+        Return the cache keys of every cached operation in the tree. Each
+        key appears once, even if the same operation appears more than
+        once in the tree.
+        """
+        keys = []
+        seen = set()
+        for node in self.operation_nodes():
+            key = node.prefixed_cache_key
+            if node.cache_seconds and key not in seen:
+                seen.add(key)
+                keys.append(key)
+        return keys
+
+    def probe_keys(self):
+        """
+        Keys of sets whose cardinalities may show that the result of this
+        operation is empty without performing it. See known_empty.
+        """
+        return []
+
+    def known_empty(self, fresh):
+        """
+        Whether the cardinalities of the probe keys, read by check_cache,
+        show that the result of this operation is empty
+        """
+        return False
+
+    def collect_probe_keys(self):
+        keys = []
+        seen = set()
+        for node in self.operation_nodes():
+            for key in node.probe_keys():
+                if key not in seen:
+                    seen.add(key)
+                    keys.append(key)
+        return keys
+
+    def check_cache(self, pipe):
+        """
+        Queue a check of the cache key of every cached operation in the
+        tree on the pipeline, followed by the cardinality of every probe
+        key. Returns the keys, in the order checked.
+        """
+        keys = self.collect_keys()
+        for key in keys:
+            pipe.exists(key)
+        probe_keys = self.collect_probe_keys()
+        for key in probe_keys:
+            pipe.scard(key)
+        return keys + probe_keys
+
+    def queue_children(self, pipe, fresh):
         for child in self.children:
-            child.create()
+            if isinstance(child, OperationNode):
+                child.queue_operation(pipe, fresh)
+
+    def queue_operation(self, pipe, fresh):
+        """
+        Queue this operation on the pipeline, after any of its children
+        whose cached results have expired. Nothing is queued for a fresh
+        operation, as it doesn't need any of its children.
+        """
+        if fresh.get(self.prefixed_cache_key):
+            return
+        if self.known_empty(fresh):
+            # An empty set doesn't exist in Redis, so unlinking the stale
+            # result is all it takes to store an empty one
+            pipe.execute_command('UNLINK', self.prefixed_key)
+        else:
+            self.queue_children(pipe, fresh)
+            # A stale result (eg if the cache key was deleted to invalidate
+            # it) would be freed synchronously when the operation overwrites
+            # it. Unlinking it first lets Redis free it in the background.
+            pipe.execute_command('UNLINK', self.prefixed_key)
+            self.perform_operation(pipe)
+        self.setup_cache(pipe)
+        # The same operation may appear elsewhere in the tree, and its
+        # result will be up to date once this pipeline has executed
+        fresh[self.prefixed_cache_key] = True
 
     def child_keys(self):
         return [child.key for child in self.children]
 
     def prefixed_child_keys(self):
-        results = []
-        for child in self.children:
-            key = child.key
-            if isinstance(child, OperationNode):
-                key = self.rs.create_key(key, generated=True)
-            else:
-                key = self.rs.create_key(key)
-            results.append(key)
-        return results
+        return [child.prefixed_key for child in self.children]
 
-    def create(self):
-        if not self.rs.redis.exists(self.prefixed_cache_key):
-            self.create_children()
-            self.perform_operation()
-            self.setup_cache()
+    # Whether the operation's command takes the number of keys before them
+    numkeys = False
+
+    def operation_options(self):
+        """
+        Arguments to this operation's command, after the keys
+        """
+        return []
+
+    def operation_args(self):
+        """
+        Arguments to this operation's command, after the result key
+        """
+        keys = self.prefixed_child_keys()
+        if self.numkeys:
+            keys = [len(keys)] + keys
+        return keys + self.operation_options()
+
+    def perform_operation(self, pipe):
+        pipe.execute_command(self.command, self.prefixed_key, *self.operation_args())
+
+    def compute_and_fetch(self, command, *args, **options):
+        """
+        Run a read command against the result of this operation, first
+        performing the operation (and any of its children) if the cached
+        result has expired. The options are passed to the redis-py
+        response callback for the read, exactly as execute_command would.
 
+        If all children are leaf nodes, this is a single round trip (see
+        COMPUTE_AND_FETCH_SCRIPT). If not, the cache keys of every cached
+        operation in the tree are checked in one round trip, and the read
+        is sent along with them in case the result is fresh. If it isn't,
+        every expired operation is queued on a second pipeline, followed
+        by the read again.
+
+        If the command is None, the result is brought up to date but
+        nothing is read.
+        """
+        if command is not None and not any(
+                isinstance(child, OperationNode) for child in self.children):
+            return self.compute_and_fetch_script(command, *args, **options)
+
+        pipe = self.rs.redis.pipeline(transaction=False)
+        keys = self.check_cache(pipe)
+        # An uncached result is never fresh, so there's no point reading it
+        if self.cache_seconds and command is not None:
+            pipe.execute_command(command, self.prefixed_key, *args, **options)
+        results = pipe.execute()
+
+        fresh = dict(zip(keys, results))
+        if fresh.get(self.prefixed_cache_key):
+            if command is not None:
+                return results[-1]
+            return
+
+        # Expired operations are performed in a MULTI/EXEC transaction, so
+        # no other client can see a result without its cache and TTL set
+        pipe = self.rs.redis.pipeline(transaction=True)
+        self.queue_operation(pipe, fresh)
+        if command is not None:
+            pipe.execute_command(command, self.prefixed_key, *args, **options)
+        results = pipe.execute()
+
+        if command is not None:
+            return results[-1]
+
+    def compute_and_fetch_script(self, command, *args, **options):
+        client = self.rs.redis
+        now = self.rs.clock()
+
+        operation_options = self.operation_options()
+        script = client.register_script(COMPUTE_AND_FETCH_SCRIPT)
+        performed, response = script(
+            keys=[self.prefixed_key, self.prefixed_cache_key] + self.prefixed_child_keys(),
+            args=[self.cache_seconds or 0, self.UNCACHED_RESULT_SECONDS,
+                  self.command, int(self.numkeys), len(operation_options)] +
+                 operation_options + [command] + list(args),
+        )
+        if performed and self.cache_seconds:
+            self.cache_updated(now)
+
+        callback = client.response_callbacks.get(command)
+        if callback:
+            return callback(response, **options)
+        return response
+
+    def create(self):
+        self.compute_and_fetch(None)
@@ -1,7 +1,7 @@
-from .base import Node, OperationNode
+from .base import LeafNode, OperationNode
 
 
-class SetNode(Node):
+class SetNode(LeafNode):
 
     """
     Represents a Redis set
@@ -15,57 +15,129 @@ class SetNode(Node):
     an API to add or remove elements.
     """
 
-    def __init__(self, rediset, key):
-        self.rs = rediset
-        self.key = key
-
     def add(self, *values):
-        self.rs.redis.sadd(self.prefixed_key, *values)
+        self.writer.sadd(self.prefixed_key, *values)
 
     def remove(self, *values):
-        self.rs.redis.srem(self.prefixed_key, *values)
+        self.writer.srem(self.prefixed_key, *values)
+
+    def iter_members(self, count=10000):
+        """
+        Iterate over the members of the set with SSCAN, fetching roughly
+        `count` at a time rather than all of them in one huge reply. Note
+        that, as with SSCAN, members added or removed during iteration
+        may or may not be returned, and a member may be returned twice.
+        """
+        return self.rs.redis.sscan_iter(self.prefixed_key, count=count)
 
 
-class IntersectionNode(OperationNode):
+class SetOperationNode(OperationNode):
 
     """
-    Represents the result of an intersection of one or more other sets
+    Represents the result of an operation on one or more sets
     """
 
-    @property
-    def key(self):
-        return "intersection(%s)" % ",".join(sorted(self.child_keys()))
+    cardinality_command = 'SCARD'
+
+    def members(self):
+        if self.cache_seconds:
+            return self.compute_and_fetch('SMEMBERS')
+
+        # Nothing will reuse an uncached result, so rather than storing it
+        # and then reading it, read it directly (eg SINTER not SINTERSTORE)
+        pipe = self.rs.redis.pipeline(transaction=False)
+        fresh = dict(zip(self.check_cache(pipe), pipe.execute()))
+        if self.known_empty(fresh):
+            return set()
+        pipe = self.rs.redis.pipeline(transaction=True)
+        self.queue_children(pipe, fresh)
+        self.read_operation(pipe)
+        return pipe.execute()[-1]
+
+    def iter_members(self, count=10000):
+        """
+        As SetNode.iter_members, except that the iteration is cut short if
+        the result expires part way through
+        """
+        if not self.cache_seconds:
+            return iter(self.members())
+        self.create()
+        return self.rs.redis.sscan_iter(self.prefixed_key, count=count)
+
+    def contains(self, item):
+        return self.compute_and_fetch('SISMEMBER', item)
+
+    def contains_many(self, *items):
+        if not items:
+            return []
+        results = self.compute_and_fetch('SMISMEMBER', *items)
+        return [bool(result) for result in results]
+
+
+class IntersectionNode(SetOperationNode):
 
-    def perform_operation(self):
-        return self.rs.redis.sinterstore(self.prefixed_key, self.prefixed_child_keys())
+    """
+    Represents the result of an intersection of one or more other sets
+    """
+
+    command = 'SINTERSTORE'
 
+    def generate_key(self):
+        return "intersection(%s)" % ",".join(sorted(self.child_keys()))
 
-class UnionNode(OperationNode):
+    def probe_keys(self):
+        """
+        Only worth checking if an empty set would save performing other
+        operations, as SINTERSTORE returns at once if a set is missing
+        """
+        if not any(isinstance(child, OperationNode) for child in self.children):
+            return []
+        return [child.prefixed_key for child in self.children
+                if isinstance(child, LeafNode)]
+
+    def known_empty(self, fresh):
+        """
+        The intersection is empty if any of its sets is (and a set that
+        doesn't exist is empty), in which case neither SINTERSTORE nor any
+        of the operations beneath it need performing.
+        """
+        for key in self.probe_keys():
+            if fresh.get(key) == 0:
+                return True
+        return False
+
+    def read_operation(self, pipe):
+        pipe.sinter(self.prefixed_child_keys())
+
+
+class UnionNode(SetOperationNode):
 
     """
     Represents the result of a union of one or more other sets
     """
 
-    @property
-    def key(self):
+    command = 'SUNIONSTORE'
+
+    def generate_key(self):
         return "union(%s)" % ",".join(sorted(self.child_keys()))
 
-    def perform_operation(self):
-        return self.rs.redis.sunionstore(self.prefixed_key, self.prefixed_child_keys())
+    def read_operation(self, pipe):
+        pipe.sunion(self.prefixed_child_keys())
 
 
-class DifferenceNode(OperationNode):
+class DifferenceNode(SetOperationNode):
 
     """
     Represents the result of the difference between the first set
     and all the successive sets
     """
 
-    @property
-    def key(self):
+    command = 'SDIFFSTORE'
+
+    def generate_key(self):
         child_keys = self.child_keys()
         child_keys = child_keys[0:1] + sorted(child_keys[1:])
         return "difference(%s)" % ",".join(child_keys)
 
-    def perform_operation(self):
-        return self.rs.redis.sdiffstore(self.prefixed_key, self.prefixed_child_keys())
+    def read_operation(self, pipe):
+        pipe.sdiff(self.prefixed_child_keys())
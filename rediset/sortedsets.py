@@ -1,4 +1,4 @@
-from .base import Node, OperationNode
+from .base import LeafNode, Node, OperationNode
 
 
 class SortedNode(Node):
@@ -7,6 +7,8 @@ class SortedNode(Node):
     Represents a node in a tree of sorted sets and sorted set operations
     """
 
+    is_sorted = True
+
     class RangeView(object):
 
         """
@@ -24,12 +26,10 @@ class SortedNode(Node):
             """
             Get a range of items from the sorted set. See redis-py docs for details
             """
-            self.proxied.create()
-
             for key, value in self.overrides.items():
                 kwargs.setdefault(key, value)
 
-            return self.proxied.rs.redis.zrange(self.proxied.prefixed_key, *args, **kwargs)
+            return self.proxied.fetch_range(*args, **kwargs)
 
         def get(self, index, *args, **kwargs):
             """
@@ -43,6 +43,8 @@ class SortedNode(Node):
         def __getitem__(self, arg):
 
             if isinstance(arg, slice):
+                if arg.step not in (None, 1):
+                    raise ValueError('Sorted set slices do not support a step')
                 start = arg.start or 0
                 if arg.stop == 0:
                     return []
@@ -89,6 +91,11 @@ class SortedNode(Node):
         self.create()
         return self.rs.redis.zcard(self.prefixed_key)
 
+    def fetch_range(self, start, end, desc=False, withscores=False, score_cast_func=float):
+        self.create()
+        return self.rs.redis.zrange(self.prefixed_key, start, end, desc=desc,
+                                    withscores=withscores, score_cast_func=score_cast_func)
+
     def members(self, *args, **kwargs):
         return self.range_view().members(*args, **kwargs)
 
@@ -98,6 +105,16 @@ class SortedNode(Node):
         """
         return self.score(item) is not None
 
+    def contains_many(self, *items):
+        """
+        As with contains, we use the scores of the items (ZMSCORE)
+        """
+        if not items:
+            return []
+        self.create()
+        results = self.rs.redis.execute_command('ZMSCORE', self.prefixed_key, *items)
+        return [result is not None for result in results]
+
     def range(self, *args, **kwargs):
         return self.range_view().range(*args, **kwargs)
 
@@ -133,34 +150,30 @@ class SortedNode(Node):
         return self.range_view().descending
 
 
-class SortedSetNode(SortedNode):
+class SortedSetNode(SortedNode, LeafNode):
 
     """
     Represents a Redis sorted set
     """
 
-    def __init__(self, rediset, key):
-        self.rs = rediset
-        self.key = key
-
     def add(self, *values):
         values = dict(values)
-        self.rs.redis.zadd(self.prefixed_key, **values)
+        self.writer.zadd(self.prefixed_key, **values)
 
     def remove(self, *values):
-        self.rs.redis.zrem(self.prefixed_key, *values)
+        self.writer.zrem(self.prefixed_key, *values)
 
     def increment(self, item, amount=1):
-        return self.rs.redis.zincrby(self.prefixed_key, item, amount)
+        return self.writer.zincrby(self.prefixed_key, item, amount)
 
     def decrement(self, item, amount=1):
         return self.increment(item, amount=amount * -1)
 
     def remrangebyrank(self, min, max):
-        return self.rs.redis.zremrangebyrank(self.prefixed_key, min, max)
+        return self.writer.zremrangebyrank(self.prefixed_key, min, max)
 
     def remrangebyscore(self, min, max):
-        return self.rs.redis.zremrangebyscore(self.prefixed_key, min, max)
+        return self.writer.zremrangebyscore(self.prefixed_key, min, max)
 
 
 class SortedOperationNode(OperationNode, SortedNode):
@@ -170,6 +183,8 @@ class SortedOperationNode(OperationNode, SortedNode):
     on sorted sets
     """
 
+    cardinality_command = 'ZCARD'
+
     def __init__(self, *args, **kwargs):
         self.aggregate = kwargs.pop('aggregate', 'SUM')
         self.weights = kwargs.pop('weights',None)
@@ -180,13 +195,39 @@ class SortedOperationNode(OperationNode, SortedNode):
         Return a key component based on the variable options passed
         to this operation, such as aggregate
         """
-        return "aggregate=%s&weights=%s" % (self.aggregate, self.weights)
+        weights = self.weights
+        if weights:
+            # Listed in the same order as the sorted child keys, so that
+            # each weight stays with its set
+            pairs = sorted(zip(self.prefixed_child_keys(), weights))
+            weights = [weight for key, weight in pairs]
+        return "aggregate=%s&weights=%s" % (self.aggregate, weights)
     
-    def weighted_child_keys(self):
+    def fetch_range(self, start, end, desc=False, withscores=False, score_cast_func=float):
+        args = [start, end]
+        if withscores:
+            args.append('WITHSCORES')
+        return self.compute_and_fetch('ZREVRANGE' if desc else 'ZRANGE', *args,
+                                      withscores=withscores, score_cast_func=score_cast_func)
+
+    def contains_many(self, *items):
+        if not items:
+            return []
+        results = self.compute_and_fetch('ZMSCORE', *items)
+        return [result is not None for result in results]
+
+    numkeys = True
+
+    def operation_options(self):
+        """
+        Arguments to ZINTERSTORE/ZUNIONSTORE after the keys. The weights
+        are passed as a list rather than a dict keyed by set, so the same
+        set can be included twice with different weights.
+        """
+        options = []
         if self.weights:
-            return dict(zip(self.prefixed_child_keys(), self.weights))
-        else:
-            return self.prefixed_child_keys()
+            options += ['WEIGHTS'] + list(self.weights)
+        return options + ['AGGREGATE', self.aggregate]
 
 
 class SortedIntersectionNode(SortedOperationNode):
@@ -195,17 +236,14 @@ class SortedIntersectionNode(SortedOperationNode):
     Represents the result of an intersection of one or more sorted sets
     """
 
-    @property
-    def key(self):
+    command = 'ZINTERSTORE'
+
+    def generate_key(self):
         return "sortedintersection(%s)(%s)" % (
-            ",".join(sorted(self.weighted_child_keys())),
+            ",".join(sorted(self.prefixed_child_keys())),
             self.extra_key_components(),
         )
 
-    def perform_operation(self):
-        return self.rs.redis.zinterstore(self.prefixed_key, self.weighted_child_keys(),
-                                              aggregate=self.aggregate)
-
 
 class SortedUnionNode(SortedOperationNode):
 
@@ -213,16 +251,14 @@ class SortedUnionNode(SortedOperationNode):
     Represents the result of a union of one or more sorted sets
     """
 
-    @property
-    def key(self):
+    command = 'ZUNIONSTORE'
+
+    def generate_key(self):
         return "sortedunion(%s)(%s)" % (
-            ",".join(sorted(self.weighted_child_keys())),
+            ",".join(sorted(self.prefixed_child_keys())),
             self.extra_key_components(),
         )
 
-    def perform_operation(self):
-        return self.rs.redis.zunionstore(self.prefixed_key, self.weighted_child_keys(),
-                                              aggregate=self.aggregate)
 
 
 class SortedDifferenceNode(SortedOperationNode):
@@ -12,7 +12,7 @@ setup(
     url='https://github.com/j4mie/rediset',
     license = 'Public Domain',
     packages=find_packages(),
-    install_requires=['redis'],
+    install_requires=['redis>=2.9,<3.0'],
     classifiers = [
         'Programming Language :: Python',
         'Development Status :: 3 - Alpha',
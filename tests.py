@@ -1,7 +1,7 @@
 from unittest import TestCase
 from mock import Mock
-from time import sleep
 from rediset import Rediset
+from rediset.base import COMPUTE_AND_FETCH_SCRIPT
 from rediset.sets import SetNode, IntersectionNode
 from rediset.sortedsets import SortedIntersectionNode, SortedUnionNode
 
@@ -29,20 +29,62 @@ class KeyGenerationTestCase(TestCase):
         key = rs.create_key('foo', generated=True)
         self.assertEqual(key, 'rediset:acbd18db4cc2f85cedef654fccc4a4d8')
 
+    def test_key_memo(self):
+        rs = Rediset(key_prefix='some-prefix', hash_generated_keys=True)
+        rs.hash_key = Mock(wraps=rs.hash_key)
+        for _ in range(3):
+            key = rs.create_key('foo', generated=True)
+        self.assertEqual(key, 'some-prefix:rediset:acbd18db4cc2f85cedef654fccc4a4d8')
+        self.assertEqual(rs.hash_key.call_count, 1)
+
+        rs.key_prefix = 'other-prefix'
+        self.assertEqual(rs.create_key('foo'), 'other-prefix:foo')
+        rs.hash_generated_keys = False
+        self.assertEqual(rs.create_key('foo', generated=True), 'other-prefix:rediset:foo')
+
+        rs.KEY_MEMO_SIZE = 2
+        for name in ['a', 'b', 'c']:
+            rs.create_key(name)
+        self.assertTrue(len(rs.key_memo) <= 2)
+
 
 class RedisTestCase(TestCase):
 
     PREFIX = 'rediset-tests'
 
+    # Deletes every key matching ARGV[1] in one round trip, rather than one
+    # to find the keys and another to delete them, and with UNLINK rather
+    # than DEL. The script is atomic, so Redis is blocked until it finishes
+    CLEANUP_SCRIPT = """
+    redis.replicate_commands()
+    local cursor = '0'
+    repeat
+        local reply = redis.call('SCAN', cursor, 'MATCH', ARGV[1], 'COUNT', 1000)
+        cursor = reply[1]
+        if #reply[2] > 0 then
+            redis.call('UNLINK', unpack(reply[2]))
+        end
+    until cursor == '0'
+    """
+
     def setUp(self):
         self.rediset = Rediset(key_prefix=self.PREFIX)
-        self.rediset.redis = Mock(wraps=self.rediset.redis)
+        # So that EVALSHA never has to fall back to loading the script,
+        # which would make the number of round trips depend on test order
+        self.rediset.redis.script_load(COMPUTE_AND_FETCH_SCRIPT)
+
+    def spy(self, *methods):
+        """
+        Wrap the given methods of this test's Redis client in Mocks, so
+        that tests can make assertions about how they were called
+        """
+        redis = self.rediset.redis
+        for method in methods:
+            setattr(redis, method, Mock(wraps=getattr(redis, method)))
 
     def tearDown(self):
-        redis = self.rediset.redis
-        keys = redis.keys('%s*' % self.PREFIX)
-        if keys:
-            redis.delete(*keys)
+        cleanup = self.rediset.redis.register_script(self.CLEANUP_SCRIPT)
+        cleanup(args=['%s*' % self.PREFIX])
 
 
 class HashingTestCase(RedisTestCase):
@@ -62,6 +104,14 @@ class HashingTestCase(RedisTestCase):
         self.assertEqual(i.prefixed_key, 'rediset-tests:rediset:e98e8da811c3c5597e0d48f47010bf91')
         self.assertEqual(i.prefixed_cache_key, 'rediset-tests:rediset:cached:e98e8da811c3c5597e0d48f47010bf91')
 
+    def test_operation_keys_are_hashed_once(self):
+        self.rediset.hash_key = Mock(wraps=self.rediset.hash_key)
+        i = self.rediset.Intersection('key1', 'key2')
+        for _ in range(3):
+            i.prefixed_key
+            i.prefixed_cache_key
+        self.assertEqual(self.rediset.hash_key.call_count, 2)
+
 
 class SetTestCase(RedisTestCase):
 
@@ -82,6 +132,19 @@ class SetTestCase(RedisTestCase):
         s.remove('b', 'c')
         self.assertEqual(len(s), 0)
 
+    def test_atomic(self):
+        self.spy('sadd', 'pipeline')
+        s = self.rediset.Set('key')
+
+        with s.atomic():
+            s.add('a')
+            s.add('b', 'c')
+            s.remove('c')
+            self.assertEqual(self.rediset.redis.sadd.call_count, 0)
+
+        self.assertEqual(self.rediset.redis.pipeline.call_count, 1)
+        self.assertEqual(s.members(), set(['a', 'b']))
+
 
 class SortedSetTestCase(RedisTestCase):
 
@@ -102,6 +165,19 @@ class SortedSetTestCase(RedisTestCase):
         s.remove('b', 'c')
         self.assertEqual(len(s), 0)
 
+    def test_atomic(self):
+        self.spy('zadd', 'pipeline')
+        s = self.rediset.SortedSet('key')
+
+        with s.atomic():
+            s.add(('a', 1))
+            s.add(('b', 2), ('c', 3))
+            s.increment('c')
+            self.assertEqual(self.rediset.redis.zadd.call_count, 0)
+
+        self.assertEqual(self.rediset.redis.pipeline.call_count, 1)
+        self.assertEqual(s.members(withscores=True), [('a', 1), ('b', 2), ('c', 4)])
+
     def test_get_members(self):
         s = self.rediset.SortedSet('key')
         s.add(('a', 1), ('b', 2), ('c', 3))
@@ -140,8 +216,15 @@ class SortedSetTestCase(RedisTestCase):
         self.assertEqual(s[1:], ['b', 'c'])
         self.assertEqual(s[:1], ['a'])
         self.assertEqual(s[0:10], ['a', 'b', 'c'])
+        self.assertEqual(s[0:2:1], ['a', 'b'])
+
+        def should_raise_value_error():
+            s[0:2:2]
+
+        self.assertRaises(ValueError, should_raise_value_error)
 
     def test_big_slice(self):
+        self.spy('zrange')
         s = self.rediset.SortedSet('key')
         for counter in range(100):
             s.add((str(counter), counter))
@@ -215,6 +298,7 @@ class SortedSetTestCase(RedisTestCase):
         self.assertEqual([item for item in s.descending], ['c','b', 'a'])
 
     def test_iteration(self):
+        self.spy('zrange')
         s = self.rediset.SortedSet('key')
         s.add(('a', 1), ('b', 2), ('c', 3))
 
@@ -305,6 +389,33 @@ class SortedSetOperationTestCase(RedisTestCase):
         self.assertTrue(isinstance(u, SortedUnionNode))
         self.assertEqual(u.weights, [0.2, 1])
 
+    def test_round_trips(self):
+        self.spy('pipeline', 'evalsha')
+        s1 = self.rediset.SortedSet('key1')
+        s2 = self.rediset.SortedSet('key2')
+        s3 = self.rediset.SortedSet('key3')
+
+        s1.add(('a', 1), ('b', 2))
+        s2.add(('b', 3), ('c', 6))
+        s3.add(('d', 1))
+
+        redis = self.rediset.redis
+        u = self.rediset.Union(s1, s2, cache_seconds=10)
+
+        # one round trip to compute and read, cold or warm
+        self.assertEqual(u.members(), ['a', 'b', 'c'])
+        self.assertEqual(redis.evalsha.call_count, 1)
+        self.assertEqual(u[0:2], ['a', 'b'])
+        self.assertEqual(redis.evalsha.call_count, 2)
+        self.assertEqual(redis.pipeline.call_count, 0)
+
+        # a tree takes two round trips cold, and one warm
+        tree = self.rediset.Union(self.rediset.Intersection(s1, s2), s3)
+        self.assertEqual(tree.members(), ['d', 'b'])
+        self.assertEqual(redis.pipeline.call_count, 2)
+        self.assertEqual(tree.descending[0:1], ['b'])
+        self.assertEqual(redis.pipeline.call_count, 3)
+
     def test_sorted_set_difference(self):
         s1 = self.rediset.SortedSet('key1')
         s2 = self.rediset.SortedSet('key2')
@@ -353,6 +464,48 @@ class IntersectionTestCase(RedisTestCase):
         i2 = s1.intersection(s2)
         self.assertEqual(i.members(), i2.members())
 
+    def test_round_trips(self):
+        self.spy('pipeline', 'evalsha', 'exists')
+        s1 = self.rediset.Set('key1')
+        s2 = self.rediset.Set('key2')
+
+        s1.add('a', 'b')
+        s2.add('b', 'c')
+
+        i = self.rediset.Intersection(s1, s2, cache_seconds=10)
+        redis = self.rediset.redis
+
+        # one round trip to compute and read
+        self.assertEqual(i.members(), set(['b']))
+        self.assertEqual(redis.evalsha.call_count, 1)
+
+        # and one to read a fresh result
+        self.assertEqual(i.members(), set(['b']))
+        self.assertTrue('b' in i)
+        self.assertEqual(redis.evalsha.call_count, 3)
+
+        self.assertEqual(redis.pipeline.call_count, 0)
+        self.assertEqual(redis.exists.call_count, 0)
+        self.assertTrue(0 < redis.ttl(i.prefixed_cache_key) <= 10)
+        self.assertTrue(0 < redis.ttl(i.prefixed_key) <= 10)
+
+    def test_script_keys(self):
+        self.spy('evalsha')
+        s1 = self.rediset.SortedSet('key1')
+        s2 = self.rediset.SortedSet('key2')
+
+        s1.add(('a', 1), ('b', 2))
+        s2.add(('b', 3))
+
+        # every key the script touches is declared, for cluster routing
+        i = self.rediset.Intersection((s1, 2), (s2, 1))
+        self.assertEqual(i.members(withscores=True), [('b', 7)])
+        args = self.rediset.redis.evalsha.call_args[0]
+        self.assertEqual(args[1], 4)
+        self.assertEqual(list(args[2:6]), [i.prefixed_key, i.prefixed_cache_key,
+                                           s1.prefixed_key, s2.prefixed_key])
+        self.assertFalse(s1.prefixed_key in args[6:])
+
     def test_intersection_tree(self):
         s1 = self.rediset.Set('key1')
         s2 = self.rediset.Set('key2')
@@ -369,12 +522,52 @@ class IntersectionTestCase(RedisTestCase):
         self.assertEqual(len(i2), 1)
         self.assertEqual(i2.members(), set(['b']))
 
+    def test_shared_subtrees(self):
+        s1 = self.rediset.Set('key1')
+        s2 = self.rediset.Set('key2')
+        s3 = self.rediset.Set('key3')
+
+        s1.add('a', 'b', 'c')
+        s2.add('b', 'c', 'd')
+        s3.add('c')
+
+        i1 = self.rediset.Intersection(s1, s2)
+        i2 = self.rediset.Intersection(s2, s1)
+        i1.perform_operation = Mock(wraps=i1.perform_operation)
+        i2.perform_operation = Mock(wraps=i2.perform_operation)
+
+        result = self.rediset.Union(i1, self.rediset.Difference(i2, s3))
+        self.assertEqual(len(result.collect_keys()), 3)
+        self.assertEqual(result.members(), set(['b', 'c']))
+        self.assertEqual(i1.perform_operation.call_count + i2.perform_operation.call_count, 1)
+
     def test_key_generation(self):
         i1 = self.rediset.Intersection('a', 'b', 'c')
         i2 = self.rediset.Intersection('c', 'b', 'a')
         i3 = self.rediset.Intersection('b' ,'c', 'a')
         self.assertTrue(i1.key == i2.key == i3.key)
 
+    def test_equality(self):
+        i1 = self.rediset.Intersection('a', 'b', 'c')
+        i2 = self.rediset.Intersection('c', 'b', 'a')
+        i3 = self.rediset.Intersection('a', 'b')
+        self.assertEqual(i1, i2)
+        self.assertNotEqual(i1, i3)
+        self.assertEqual(len(set([i1, i2, i3])), 2)
+        self.assertEqual(self.rediset.Set('a'), self.rediset.Set('a'))
+        self.assertNotEqual(self.rediset.Set('a'), 'a')
+        self.assertNotEqual(self.rediset.Set('a'), self.rediset.SortedSet('a'))
+        self.assertEqual(len(set([self.rediset.Set('a'), self.rediset.SortedSet('a')])), 2)
+
+    def test_repeated_sets(self):
+        s1 = self.rediset.Set('key1')
+        s2 = self.rediset.Set('key2')
+
+        i1 = self.rediset.Intersection('key1', s1, s2, 'key2')
+        self.assertEqual(i1.key, self.rediset.Intersection(s1, s2).key)
+        self.assertEqual(len(i1.children), 2)
+        self.assertTrue(self.rediset.Intersection(s1, s1) is s1)
+
     def test_sorted_set_intersection(self):
         s1 = self.rediset.SortedSet('key1')
         s2 = self.rediset.SortedSet('key2')
@@ -460,6 +653,23 @@ class UnionTestCase(RedisTestCase):
         u5 = self.rediset.Union(s1, s2, aggregate='MIN')
         self.assertEqual(u5.members(withscores=True), [('a', 1), ('b', 2), ('c', 6)])
 
+    def test_weighted_sorted_set_union(self):
+        s1 = self.rediset.SortedSet('key1')
+        s2 = self.rediset.SortedSet('key2')
+
+        s1.add(('a', 1), ('b', 2))
+        s2.add(('b', 3), ('c', 6))
+
+        u1 = self.rediset.Union((s1, 1), (s2, 2))
+        u2 = self.rediset.Union((s2, 1), (s1, 2))
+        self.assertNotEqual(u1.key, u2.key)
+        self.assertEqual(u1.key, self.rediset.Union((s2, 2), (s1, 1)).key)
+        self.assertEqual(u1.members(withscores=True), [('a', 1), ('b', 8), ('c', 12)])
+        self.assertEqual(u2.members(withscores=True), [('a', 2), ('c', 6), ('b', 7)])
+
+        u3 = self.rediset.Union((s1, 1), (s1, 2))
+        self.assertEqual(u3.members(withscores=True), [('a', 3), ('b', 6)])
+
 
 class DifferenceTestCase(RedisTestCase):
 
@@ -502,6 +712,14 @@ class DifferenceTestCase(RedisTestCase):
         d3 = self.rediset.Difference('b' ,'c', 'a')
         self.assertEqual(d1.key, d2.key)
         self.assertNotEqual(d1.key, d3.key)
+        self.assertEqual(d1, d2)
+        self.assertNotEqual(d1, d3)
+
+    def test_repeated_sets(self):
+        d1 = self.rediset.Difference('a', 'b', 'b', 'c')
+        self.assertEqual(d1.key, self.rediset.Difference('a', 'b', 'c').key)
+        d2 = self.rediset.Difference('a', 'a')
+        self.assertEqual(len(d2.children), 2)
 
 
 class ShortcutTestCase(RedisTestCase):
@@ -564,15 +782,69 @@ class CombinationTestCase(RedisTestCase):
         self.assertEqual(len(result), 4)
         self.assertEqual(result.members(), set(['b', 'e', 'f', 'z']))
 
+    def test_tree_round_trips(self):
+        self.spy('pipeline', 'exists')
+        s1 = self.rediset.Set('key1')
+        s2 = self.rediset.Set('key2')
+        s3 = self.rediset.Set('key3')
+
+        s1.add('a', 'b')
+        s2.add('b', 'c')
+        s3.add('c', 'd')
+
+        inner = self.rediset.Intersection(s1, s2)
+        inner.perform_operation = Mock(wraps=inner.perform_operation)
+        result = self.rediset.Union(inner, s3)
+
+        # one round trip to check the cache, one to compute and read
+        self.assertEqual(result.members(), set(['b', 'c', 'd']))
+        self.assertEqual(self.rediset.redis.pipeline.call_count, 2)
+        self.assertEqual(self.rediset.redis.exists.call_count, 0)
+        self.assertEqual(inner.perform_operation.call_count, 1)
+
+        # fresh results aren't computed again, and are read in one round trip
+        self.assertEqual(result.members(), set(['b', 'c', 'd']))
+        self.assertEqual(self.rediset.redis.pipeline.call_count, 3)
+        self.assertEqual(inner.perform_operation.call_count, 1)
+
 
 class ConversionTestCase(RedisTestCase):
 
     def test_iterable(self):
+        self.spy('sscan_iter', 'smembers')
         s1 = self.rediset.Set('key1')
         s1.add('a', 'b', 'c')
         self.assertEqual(set(s1), set(['a', 'b', 'c']))
+        self.assertEqual(len(list(s1)), 3)
+        self.assertEqual(self.rediset.redis.sscan_iter.call_count, 0)
+        self.assertEqual(self.rediset.redis.smembers.call_count, 2)
+
+    def test_members_frozen(self):
+        s1 = self.rediset.Set('key1')
+        s1.add('a', 'b', 'c')
+        self.assertEqual(s1.members_frozen(), frozenset(['a', 'b', 'c']))
+
+        s2 = self.rediset.SortedSet('key2')
+        s2.add(('a', 1), ('b', 2))
+        self.assertEqual(s2.members_frozen(withscores=True), frozenset([('a', 1), ('b', 2)]))
+
+    def test_iter_members(self):
+        s1 = self.rediset.Set('key1')
+        s1.add(*range(100))
+        self.assertEqual(set(s1.iter_members(count=10)), set(str(i) for i in range(100)))
+
+        s2 = self.rediset.Set('key2')
+        s2.add('1', '2', 'x')
+        i = self.rediset.Intersection(s1, s2)
+        self.assertEqual(set(i.iter_members()), set(['1', '2']))
+
+        # SSCAN only works on sets
+        s3 = self.rediset.SortedSet('key3')
+        self.assertFalse(hasattr(s3, 'iter_members'))
+        self.assertFalse(hasattr(self.rediset.Union(s3, self.rediset.SortedSet('key4')), 'iter_members'))
 
     def test_contains(self):
+        self.spy('sismember')
         s1 = self.rediset.Set('key1')
         s1.add('a', 'b', 'c')
         self.assertTrue('a' in s1)
@@ -580,6 +852,44 @@ class ConversionTestCase(RedisTestCase):
         self.assertFalse('x' in s1)
         self.rediset.redis.sismember.assert_called_with('%s:key1' % self.PREFIX, 'x')
 
+    def test_contains_many(self):
+        self.spy('execute_command', 'sismember')
+        s1 = self.rediset.Set('key1')
+        s1.add('a', 'b', 'c')
+        self.assertEqual(s1.contains_many('a', 'x', 'c'), [True, False, True])
+        self.assertEqual(s1.contains_many(), [])
+        self.rediset.redis.execute_command.assert_called_with('SMISMEMBER', '%s:key1' % self.PREFIX, 'a', 'x', 'c')
+        self.assertEqual(self.rediset.redis.sismember.call_count, 0)
+
+        s2 = self.rediset.Set('key2')
+        s2.add('b', 'c', 'd')
+        self.spy('evalsha', 'pipeline')
+        i = self.rediset.Intersection(s1, s2)
+        self.assertEqual(i.contains_many('a', 'b', 'c'), [False, True, True])
+        self.assertEqual(i.contains_many(), [])
+        self.assertEqual(self.rediset.redis.evalsha.call_count, 1)
+        self.assertEqual(self.rediset.redis.pipeline.call_count, 0)
+
+        u = self.rediset.Union(i, 'key3')
+        self.assertEqual(u.contains_many('a', 'b'), [False, True])
+
+    def test_sorted_contains_many(self):
+        s = self.rediset.SortedSet('key1')
+        s.add(('a', 1), ('b', 2))
+        self.assertEqual(s.contains_many('a', 'x', 'b'), [True, False, True])
+        self.assertEqual(s.descending.contains_many('x'), [False])
+
+        s2 = self.rediset.SortedSet('key2')
+        s2.add(('b', 1), ('c', 2))
+        self.spy('evalsha', 'pipeline')
+        u = self.rediset.Union(s, s2)
+        self.assertEqual(u.contains_many('a', 'x', 'c'), [True, False, True])
+        self.assertEqual(self.rediset.redis.evalsha.call_count, 1)
+        self.assertEqual(self.rediset.redis.pipeline.call_count, 0)
+
+        tree = self.rediset.Union(self.rediset.Intersection(s, s2), s2)
+        self.assertEqual(tree.contains_many('a', 'b'), [False, True])
+
 
 class CachingTestCase(RedisTestCase):
 
@@ -595,24 +905,132 @@ class CachingTestCase(RedisTestCase):
         self.assertEqual(intersection.cache_seconds, 5)
 
     def test_caching(self):
+        self.spy('evalsha')
         s1 = self.rediset.Set('key1')
         s2 = self.rediset.Set('key2')
 
         s1.add('a', 'b')
         s2.add('b', 'c')
 
+        now = [1000.0]
+        self.rediset.clock = lambda: now[0]
+
         intersection = self.rediset.Intersection(s1, s2, cache_seconds=1)
 
         len(intersection)
         len(intersection)
 
-        self.assertEqual(intersection.rs.redis.sinterstore.call_count, 1)
-
-        sleep(2)
+        # performed once, and each read is one round trip
+        self.assertEqual(intersection.cache_expires, 1001.0)
+        self.assertEqual(self.rediset.redis.evalsha.call_count, 2)
 
+        # the operation is performed again once it has expired in Redis
+        now[0] += 2
+        self.rediset.redis.delete(intersection.prefixed_cache_key)
         len(intersection)
 
-        self.assertEqual(intersection.rs.redis.sinterstore.call_count, 2)
+        self.assertEqual(intersection.cache_expires, 1003.0)
+        self.assertEqual(self.rediset.redis.evalsha.call_count, 3)
+
+    def test_invalidation(self):
+        s1 = self.rediset.Set('key1')
+        s1.add('a', 'b')
+        s2 = self.rediset.Set('key2')
+        s2.add('b', 'c')
+
+        union = self.rediset.Union(s1, s2)
+        self.assertEqual(len(union), 3)
+
+        s1.remove('a')
+        self.rediset.redis.delete(union.prefixed_cache_key)
+        self.assertEqual(union.members(), set(['b', 'c']))
+
+    def test_stale_results_are_unlinked(self):
+        s1 = self.rediset.Set('key1')
+        s1.add('a', 'b')
+        s2 = self.rediset.Set('key2')
+        s2.add('b', 'c')
+
+        union = self.rediset.Union(self.rediset.Intersection(s1, s2), s2)
+        self.assertEqual(len(union), 2)
+
+        queued = []
+        perform_operation = union.perform_operation
+        def record(pipe):
+            queued.append([args[:2] for args, options in pipe.command_stack])
+            perform_operation(pipe)
+        union.perform_operation = record
+
+        self.rediset.redis.delete(union.prefixed_cache_key)
+        self.assertEqual(union.members(), set(['b', 'c']))
+        self.assertEqual(queued[0][-1], ('UNLINK', union.prefixed_key))
+
+    def test_cardinality_invalidation(self):
+        s1 = self.rediset.Set('key1')
+        s1.add('a', 'b')
+        s2 = self.rediset.Set('key2')
+        s2.add('b', 'c')
+
+        union = self.rediset.Union(s1, s2)
+        self.assertEqual(len(union), 3)
+
+        s1.remove('a')
+        self.rediset.redis.delete(union.prefixed_cache_key)
+        self.assertEqual(len(self.rediset.Union(s1, s2)), 2)
+        self.assertEqual(len(union), 2)
+
+    def test_uncached(self):
+        s1 = self.rediset.Set('key1')
+        s2 = self.rediset.Set('key2')
+        s3 = self.rediset.Set('key3')
+
+        s1.add('a', 'b')
+        s2.add('b', 'c')
+        s3.add('c', 'd')
+
+        intersection = self.rediset.Intersection(s1, s2, cache_seconds=0)
+        intersection.perform_operation = Mock(wraps=intersection.perform_operation)
+
+        # the members are read directly, without storing the result
+        self.assertEqual(intersection.members(), set(['b']))
+        self.assertEqual(set(intersection), set(['b']))
+        self.assertEqual(intersection.perform_operation.call_count, 0)
+        self.assertFalse(self.rediset.redis.exists(intersection.prefixed_key))
+
+        # other reads store a short-lived result, and never cache it
+        self.assertEqual(len(intersection), 1)
+        s1.add('c')
+        self.assertEqual(len(intersection), 2)
+        self.assertEqual(intersection.cache_expires, None)
+        self.assertFalse(self.rediset.redis.exists(intersection.prefixed_cache_key))
+        self.assertTrue(self.rediset.redis.ttl(intersection.prefixed_key) <= 10)
+
+        union = self.rediset.Union(intersection, s3)
+        self.assertEqual(union.members(), set(['b', 'c', 'd']))
+        self.assertEqual(len(union), 3)
+
+        union = self.rediset.Union(self.rediset.Intersection(s1, s2), s3, cache_seconds=0)
+        self.assertEqual(union.members(), set(['b', 'c', 'd']))
+
+    def test_cached_and_uncached(self):
+        s1 = self.rediset.Set('key1')
+        s2 = self.rediset.Set('key2')
+
+        s1.add('a', 'b')
+        s2.add('b', 'c')
+
+        cached = self.rediset.Intersection(s1, s2, cache_seconds=60)
+        uncached = self.rediset.Intersection(s1, s2, cache_seconds=0)
+        self.assertNotEqual(cached.prefixed_key, uncached.prefixed_key)
+
+        self.assertEqual(cached.members(), set(['b']))
+        self.assertEqual(len(uncached), 1)
+
+        # storing the uncached result leaves the cached one alone
+        self.assertTrue(self.rediset.redis.ttl(cached.prefixed_key) > 10)
+        self.assertTrue(self.rediset.redis.ttl(uncached.prefixed_key) <= 10)
+        self.rediset.redis.delete(uncached.prefixed_key)
+        self.assertEqual(cached.members(), set(['b']))
 
     def test_caching_empty_sets(self):
         s1 = self.rediset.Set('key1')
@@ -621,9 +1039,48 @@ class CachingTestCase(RedisTestCase):
         s1.add('a', 'b')
         s2.add('c', 'd')
 
+        now = [1000.0]
+        self.rediset.clock = lambda: now[0]
+
         intersection = self.rediset.Intersection(s1, s2, cache_seconds=1)
 
-        len(intersection)
-        len(intersection)
+        self.assertEqual(intersection.members(), set())
+        now[0] += 0.5
+        self.assertEqual(intersection.members(), set())
+
+        # the empty result was cached, and not performed again
+        self.assertEqual(intersection.cache_expires, 1001.0)
 
-        self.assertEqual(intersection.rs.redis.sinterstore.call_count, 1)
+    def test_intersection_with_empty_set(self):
+        self.spy('pipeline')
+        s1 = self.rediset.Set('key1')
+        s2 = self.rediset.Set('key2')
+        s3 = self.rediset.Set('key3')
+
+        s1.add('a', 'b')
+        s2.add('a', 'b')
+
+        union = self.rediset.Union(s1, s2)
+        union.perform_operation = Mock(wraps=union.perform_operation)
+        intersection = self.rediset.Intersection(union, s3, cache_seconds=1)
+        intersection.perform_operation = Mock(wraps=intersection.perform_operation)
+
+        # the sizes of the sets are checked along with the cache
+        self.assertEqual(intersection.members(), set())
+        self.assertEqual(self.rediset.redis.pipeline.call_count, 2)
+        self.assertEqual(union.perform_operation.call_count, 0)
+        self.assertEqual(intersection.perform_operation.call_count, 0)
+
+        self.assertEqual(len(intersection), 0)
+        self.assertEqual(self.rediset.redis.pipeline.call_count, 3)
+
+        uncached = self.rediset.Intersection(union, s3, cache_seconds=0)
+        self.assertEqual(uncached.members(), set())
+        self.assertEqual(union.perform_operation.call_count, 0)
+
+        # checking the sizes costs no extra round trip if no set is empty
+        s3.add('a')
+        other = self.rediset.Intersection(union, s1, s3)
+        self.assertEqual(other.members(), set(['a']))
+        self.assertEqual(self.rediset.redis.pipeline.call_count, 6)
+        self.assertEqual(union.perform_operation.call_count, 1)